@@ -12,14 +12,14 @@ from transformers import (
     AutoTokenizer,
     PreTrainedModel,
     PreTrainedTokenizer,
-    DefaultDataCollator, set_seed,
+    set_seed,
 )
 import torch
-from torch.utils.data import DataLoader
 import pandas as pd
 import numpy as np
 from transformers.utils import PaddingStrategy
 
+from src.data import batched_dataloader
 from src.types import HiddenRepresentationConfig
 from src.utils import (
     get_tokenization_fn,
@@ -178,10 +178,10 @@ def main():
             dataset = process_hf(df)
             logger.warning(f"Finished preprocessing for sample {sample_id}")
 
-            dataloader = DataLoader(
+            # examples are padded to max_length, so whole batches can be fetched at once
+            dataloader = batched_dataloader(
                 dataset,
                 batch_size=args.batch_size,
-                collate_fn=DefaultDataCollator(return_tensors="pt"),
             )
             embeddings = get_representations(
                 model,
@@ -3,9 +3,9 @@ from argparse import ArgumentParser
 
 import pandas as pd
 import torch
-from torch.utils.data import DataLoader
-from transformers import AutoModelForSequenceClassification, AutoTokenizer, DefaultDataCollator
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
+from src.data import batched_dataloader
 from src.preprocess.steps import multihot_to_list, to_hf_dataset, hf_map, convert_to_torch, sequence_columns
 from src.trainer import do_predict
 from src.utils import get_labels, pipeline, get_tokenization_fn, setup_logging
@@ -112,13 +112,12 @@ def main():
 
     logger.warning(f"Datasets successfully preprocessed.")
 
-    dataloader = DataLoader(
+    # examples are padded to max_length, so whole batches can be fetched at once
+    dataloader = batched_dataloader(
         dataset,
         batch_size=args.batch_size,
-        shuffle=False,
         num_workers=4,
         pin_memory=True,
-        collate_fn=DefaultDataCollator(return_tensors="pt")
     )
 
     # obtain predictions
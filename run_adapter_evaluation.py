@@ -5,8 +5,8 @@ from pprint import pformat
 
 import mlflow
 import pandas as pd
-from torch.utils.data import DataLoader
-from transformers import AutoTokenizer, DefaultDataCollator, AutoAdapterModel
+from transformers import AutoTokenizer, AutoAdapterModel
+from src.data import batched_dataloader
 from src.preprocess.steps import multihot_to_list, to_hf_dataset, hf_map, convert_to_torch, sequence_columns
 from src.trainer import evaluate_finetuning
 from src.utils import setup_logging, get_labels, get_tokenization_fn, pipeline
@@ -159,13 +159,12 @@ def main():
 
         logger.warning(f"Dataset {dataset_name} processed successfully.")
 
-        dataloader = DataLoader(
+        # examples are padded to max_length, so whole batches can be fetched at once
+        dataloader = batched_dataloader(
             dataset,
             batch_size=args.batch_size,
-            shuffle=False,
             num_workers=4,
             pin_memory=True,
-            collate_fn=DefaultDataCollator(return_tensors="pt")
         )
 
         do_evaluate = evaluate_finetuning(
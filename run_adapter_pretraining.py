@@ -2,15 +2,13 @@ import logging
 import os
 from functools import partial
 
-import pandas as pd
 from math import ceil
-from pandas import DataFrame
 from transformers import set_seed, DataCollatorForLanguageModeling, AutoModelForMaskedLM, AdapterConfig, \
     AutoAdapterModel
 import torch
 
 from src.cli import parse_args
-from src.preprocess import hf_map, to_hf_dataset, sequence_columns, convert_to_torch
+from src.preprocess import hf_map, default_num_proc, load_csv, drop_missing, sequence_columns, convert_to_torch
 from src.trainer import train, pretraining_loss, evaluate_pretraining
 from src.utils import setup_logging, maybe_tf32, get_tokenizer, get_tokenization_fn, pipeline, setup_optimizers, \
     save_adapter_model
@@ -37,10 +35,9 @@ def main():
     )  # would be cool to abstract this also
 
     do_preprocess = pipeline(
-        pd.read_csv,
-        DataFrame.dropna,
-        to_hf_dataset,
-        hf_map(do_tokenize, batched=True),
+        load_csv(num_proc=default_num_proc()),
+        drop_missing(num_proc=default_num_proc()),
+        hf_map(do_tokenize, batched=True, batch_size=2000, num_proc=default_num_proc()),
         convert_to_torch(columns=sequence_columns)
     )
 
@@ -118,6 +115,7 @@ def main():
             tokenizer=tokenizer,
             mlm=True,
             mlm_probability=args.mlm_probability,
+            pad_to_multiple_of=8,
         ),
         per_device_train_batch_size=args.per_device_train_batch_size,
         per_device_eval_batch_size=args.per_device_eval_batch_size,
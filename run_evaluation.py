@@ -6,22 +6,22 @@ from pprint import pformat
 
 import mlflow
 import numpy as np
-import pandas as pd
 from omegaconf import DictConfig, OmegaConf
 from sklearn.decomposition import PCA
 from torch.utils.data import DataLoader
 from transformers import (
     AutoTokenizer,
     AutoModelForSequenceClassification,
-    DefaultDataCollator, AutoAdapterModel,
+    DataCollatorWithPadding, AutoAdapterModel,
 )
 
 from src.distances.pairwise_distances import compute_pairwise_distances
 from src.model_utils import setup_adapters, maybe_compile, set_device
 from src.preprocess.steps import (
-    multihot_to_list,
-    to_hf_dataset,
+    load_csv,
+    hf_multihot_to_list,
     hf_map,
+    default_num_proc,
     convert_to_torch,
     sequence_columns,
 )
@@ -55,9 +55,9 @@ def main(args: DictConfig):
     # checkpoint_step = checkpoint_name.split("/")[-1].split("-")[0]
     # since we assume responsibility to the caller, why not just accept checkpoint step efrom the caller
 
-    tokenizer = AutoTokenizer.from_pretrained(args.model.pretrained_model_name_or_path, model_max_length=64, do_lower_case=True,)
+    tokenizer = AutoTokenizer.from_pretrained(args.model.pretrained_model_name_or_path, model_max_length=64, do_lower_case=True, use_fast=True,)
 
-    do_tokenize = get_tokenization_fn(tokenizer=tokenizer, padding="max_length", truncation=True, max_length=64, message_column="preprocessed",)
+    do_tokenize = get_tokenization_fn(tokenizer=tokenizer, padding=False, truncation=True, max_length=64, message_column="preprocessed",)
 
     # load model
     if adapters_included := hasattr(args.model, "adapters"):
@@ -75,19 +75,21 @@ def main(args: DictConfig):
     print(model)
 
     do_preprocess = pipeline(
-        pd.read_csv,
-        multihot_to_list(label_columns=labels, result_column="labels"),
-        to_hf_dataset,
-        hf_map(do_tokenize, batched=True),
+        load_csv(num_proc=default_num_proc()),
+        hf_multihot_to_list(label_columns=labels, result_column="labels", num_proc=default_num_proc()),
+        hf_map(do_tokenize, batched=True, batch_size=2000, num_proc=default_num_proc()),
         convert_to_torch(columns=sequence_columns),
     )
 
     source_dataset = do_preprocess(args.data.source_dataset_path)
     target_dataset = do_preprocess(args.data.target_dataset_path)
 
-    source_dataloader = DataLoader(source_dataset, batch_size=args.batch_size, shuffle=False, num_workers=8, pin_memory=True, collate_fn=DefaultDataCollator(return_tensors="pt"),)
+    # pad each batch to its longest sequence, rounded up to a multiple of 8 for tensor cores
+    collate_fn = DataCollatorWithPadding(tokenizer, pad_to_multiple_of=8, return_tensors="pt")
 
-    target_dataloader = DataLoader(target_dataset, batch_size=args.batch_size, shuffle=False, num_workers=8, pin_memory=True, collate_fn=DefaultDataCollator(return_tensors="pt"),)
+    source_dataloader = DataLoader(source_dataset, batch_size=args.batch_size, shuffle=False, num_workers=8, pin_memory=True, collate_fn=collate_fn,)
+
+    target_dataloader = DataLoader(target_dataset, batch_size=args.batch_size, shuffle=False, num_workers=8, pin_memory=True, collate_fn=collate_fn,)
 
     source_predictions, source_references, source_hidden_states = do_predict(model, source_dataloader, output_hidden_states=True)
     target_predictions, target_references, target_hidden_states = do_predict(model, target_dataloader, output_hidden_states=True)
@@ -5,16 +5,16 @@ from functools import partial
 import hydra
 import pandas as pd
 from omegaconf import DictConfig, OmegaConf
-from pandas import DataFrame
 from transformers import (
-    set_seed, AutoAdapterModel, AutoModelForSequenceClassification,
+    set_seed, AutoAdapterModel, AutoModelForSequenceClassification, DataCollatorWithPadding,
 )
 
-from src.model_utils import setup_adapters, maybe_compile, set_device
-from src.preprocess.steps import multihot_to_list, to_hf_dataset, hf_map, convert_to_torch, sequence_columns
-from src.trainer import train, fine_tuning_loss, evaluate_finetuning
-from src.utils import get_labels, get_tokenization_fn, setup_optimizers, maybe_tf32, get_tokenizer, \
-    pipeline, mean_binary_cross_entropy, save_adapter_model, save_transformer_model, get_adapter_saver
+from src.model_utils import setup_adapters, maybe_compile, set_device, maybe_init_distributed, maybe_ddp, \
+    get_world_size, is_main_process, maybe_destroy_distributed, main_process_first
+from src.preprocess.steps import load_csv, drop_missing, hf_multihot_to_list, hf_map, default_num_proc, disk_cached, tokenizer_fingerprint, convert_to_torch, sequence_columns
+from src.trainer import train, model_loss, evaluate_finetuning
+from src.utils import get_labels, get_tokenization_fn, setup_optimizers, maybe_tf32, get_amp_dtype, get_tokenizer, \
+    pipeline, save_adapter_model, save_transformer_model, get_adapter_saver
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +29,8 @@ def main(args: DictConfig):
     os.environ["TRANSFORMERS_NO_ADVISORY_WARNINGS"] = "1"
     os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+    maybe_init_distributed()
+
     # removed setup_logging because hydra does that for me
 
     set_seed(args.random_seed)  # oh but this actually already works because argparse has __getattr__ implemented
@@ -47,19 +49,34 @@ def main(args: DictConfig):
     labels = get_labels(args.data.labels_path)
 
     do_preprocess = pipeline(
-        pd.read_csv,
-        DataFrame.dropna,
-        multihot_to_list(
+        load_csv(num_proc=default_num_proc()),
+        drop_missing(num_proc=default_num_proc()),
+        hf_multihot_to_list(
             label_columns=labels,
-            result_column="labels"
+            result_column="labels",
+            num_proc=default_num_proc()
         ),
-        to_hf_dataset,
-        hf_map(do_tokenize, batched=True),
+        hf_map(do_tokenize, batched=True, batch_size=2000, num_proc=default_num_proc()),
         convert_to_torch(columns=sequence_columns)
     )
 
-    train_dataset = do_preprocess(args.data.train_dataset_path)
-    eval_dataset = do_preprocess(args.data.eval_dataset_path)
+    if hasattr(args.data, "preprocessing_cache_dir"):
+        do_preprocess = disk_cached(
+            do_preprocess,
+            args.data.preprocessing_cache_dir,
+            tokenizer_fingerprint(tokenizer),
+            args.tokenizer.do_lower_case,
+            args.tokenizer.max_length,
+            args.tokenizer.padding,
+            args.data.message_column,
+            labels
+        )
+
+    # under DDP, the main process preprocesses first and the others load its cached datasets,
+    # instead of every process running the same pipeline (with its own workers) at the same time
+    with main_process_first():
+        train_dataset = do_preprocess(args.data.train_dataset_path)
+        eval_dataset = do_preprocess(args.data.eval_dataset_path)
 
     if adapters_included := hasattr(args.model, "adapters"):
         model = AutoAdapterModel.from_pretrained(
@@ -77,10 +94,11 @@ def main(args: DictConfig):
 
     model = maybe_compile(model, args)
     model = set_device(model, args)
+    model = maybe_ddp(model)
 
     # TODO - fix this for "domain adaptation"
 
-    epoch_steps = len(train_dataset) // args.training.per_device_train_batch_size // args.training.gradient_accumulation_steps
+    epoch_steps = len(train_dataset) // get_world_size() // args.training.per_device_train_batch_size // args.training.gradient_accumulation_steps
     optimizer, scheduler = setup_optimizers(
         model,
         lr=args.optimizer.learning_rate,
@@ -93,7 +111,7 @@ def main(args: DictConfig):
         scheduler_type=args.optimizer.scheduler_type
     )
 
-    if use_mlflow := hasattr(args, "mlflow"):
+    if use_mlflow := hasattr(args, "mlflow") and is_main_process():  # log only from the main process
         import mlflow
         mlflow.set_tracking_uri(args.mlflow.tracking_uri)
         mlflow_experiment = mlflow.set_experiment(args.mlflow.experiment)
@@ -125,18 +143,26 @@ def main(args: DictConfig):
         scheduler=scheduler,
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
+        collate_fn=DataCollatorWithPadding(
+            tokenizer=tokenizer,
+            pad_to_multiple_of=8,
+            return_tensors="pt"
+        ),
         per_device_train_batch_size=args.training.per_device_train_batch_size,
         per_device_eval_batch_size=args.training.per_device_eval_batch_size,
         epochs=args.training.epochs,
         max_grad_norm=args.training.max_grad_norm,
         do_evaluate=evaluate_finetuning(
             evaluation_threshold=args.training.evaluation_threshold,
+            amp_dtype=get_amp_dtype(args),
         ),
-        get_loss=fine_tuning_loss(loss_fn=mean_binary_cross_entropy),
+        get_loss=model_loss(),  # the model computes the mean binary cross entropy itself
         gradient_accumulation_steps=args.training.gradient_accumulation_steps,
+        group_by_length=args.training.group_by_length,
         use_mlflow=use_mlflow,
         evaluate_on_train=args.training.evaluate_on_train,
         dataloader_num_workers=args.training.dataloader_num_workers,
+        amp_dtype=get_amp_dtype(args),
         model_saving_callback=get_adapter_saver("finetuning")
         if adapters_included
         else save_transformer_model
@@ -147,6 +173,8 @@ def main(args: DictConfig):
     if use_mlflow:
         mlflow.end_run()
 
+    maybe_destroy_distributed()
+
 
 if __name__ == "__main__":
     main()
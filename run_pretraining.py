@@ -5,13 +5,13 @@ import hydra
 import pandas as pd
 from math import ceil
 from omegaconf import OmegaConf, DictConfig
-from pandas import DataFrame
 from transformers import set_seed, DataCollatorForLanguageModeling, AutoModelForMaskedLM, AutoAdapterModel
 
-from src.model_utils import setup_adapters, maybe_compile, set_device
-from src.preprocess import hf_map, to_hf_dataset, sequence_columns, convert_to_torch
+from src.model_utils import setup_adapters, maybe_compile, set_device, maybe_init_distributed, maybe_ddp, \
+    get_world_size, is_main_process, maybe_destroy_distributed, main_process_first
+from src.preprocess import hf_map, default_num_proc, load_csv, drop_missing, disk_cached, tokenizer_fingerprint, sequence_columns, convert_to_torch
 from src.trainer import train, pretraining_loss, evaluate_pretraining
-from src.utils import maybe_tf32, get_tokenizer, get_tokenization_fn, pipeline, setup_optimizers, get_adapter_saver, \
+from src.utils import maybe_tf32, get_amp_dtype, get_tokenizer, get_tokenization_fn, pipeline, setup_optimizers, get_adapter_saver, \
     save_transformer_model
 
 logger = logging.getLogger(__name__)
@@ -29,6 +29,8 @@ def main(args: DictConfig):
     os.environ["TRANSFORMERS_NO_ADVISORY_WARNINGS"] = "1"
     os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+    maybe_init_distributed()
+
     set_seed(args.random_seed)
     maybe_tf32(args)
 
@@ -44,15 +46,29 @@ def main(args: DictConfig):
     )  # would be cool to abstract this also
 
     do_preprocess = pipeline(
-        pd.read_csv,
-        DataFrame.dropna,
-        to_hf_dataset,
-        hf_map(do_tokenize, batched=True),
+        load_csv(num_proc=default_num_proc()),
+        drop_missing(num_proc=default_num_proc()),
+        hf_map(do_tokenize, batched=True, batch_size=2000, num_proc=default_num_proc()),
         convert_to_torch(columns=sequence_columns)
     )
 
-    train_dataset = do_preprocess(args.data.train_dataset_path)
-    eval_dataset = do_preprocess(args.data.eval_dataset_path)
+    if hasattr(args.data, "preprocessing_cache_dir"):
+        do_preprocess = disk_cached(
+            do_preprocess,
+            args.data.preprocessing_cache_dir,
+            tokenizer_fingerprint(tokenizer),
+            args.tokenizer.do_lower_case,
+            args.tokenizer.max_length,
+            args.tokenizer.padding,
+            args.data.message_column,
+            "special_tokens_mask"
+        )
+
+    # under DDP, the main process preprocesses first and the others load its cached datasets,
+    # instead of every process running the same pipeline (with its own workers) at the same time
+    with main_process_first():
+        train_dataset = do_preprocess(args.data.train_dataset_path)
+        eval_dataset = do_preprocess(args.data.eval_dataset_path)
 
     # initialize model
 
@@ -73,7 +89,9 @@ def main(args: DictConfig):
 
     logger.info(f"Model loaded successfully on device: {model.device}")
 
-    epoch_steps = ceil(len(train_dataset) / args.training.per_device_train_batch_size / args.training.gradient_accumulation_steps)
+    model = maybe_ddp(model)
+
+    epoch_steps = ceil(len(train_dataset) / get_world_size() / args.training.per_device_train_batch_size / args.training.gradient_accumulation_steps)
 
     # TODO - make configurable
     optimizer, scheduler = setup_optimizers(
@@ -88,7 +106,7 @@ def main(args: DictConfig):
         scheduler_type=args.optimizer.scheduler_type
     )
 
-    if use_mlflow := hasattr(args, "mlflow"):
+    if use_mlflow := hasattr(args, "mlflow") and is_main_process():  # log only from the main process
         import mlflow
         mlflow.set_tracking_uri(args.mlflow.tracking_uri)
         mlflow_experiment = mlflow.set_experiment(args.mlflow.experiment)
@@ -121,16 +139,19 @@ def main(args: DictConfig):
             tokenizer=tokenizer,
             mlm=True,
             mlm_probability=args.mlm_probability,
+            pad_to_multiple_of=8,
         ),
         per_device_train_batch_size=args.training.per_device_train_batch_size,
         per_device_eval_batch_size=args.training.per_device_eval_batch_size,
         epochs=args.training.epochs,
         max_grad_norm=args.training.max_grad_norm,
         gradient_accumulation_steps=args.training.gradient_accumulation_steps,
+        group_by_length=args.training.group_by_length,
         get_loss=pretraining_loss(),
         do_evaluate=evaluate_pretraining(),
         use_mlflow=use_mlflow,
         dataloader_num_workers=args.training.dataloader_num_workers,
+        amp_dtype=get_amp_dtype(args),
         model_saving_callback=get_adapter_saver("pretraining") if adapters_included else save_transformer_model
     )
 
@@ -139,6 +160,8 @@ def main(args: DictConfig):
     if use_mlflow:
         mlflow.end_run()
 
+    maybe_destroy_distributed()
+
 
 if __name__ == "__main__":
     main()
@@ -1,9 +1,13 @@
 import logging
+from math import ceil
 from pprint import pformat
+from typing import Iterator
 
 import pandas as pd
+import torch
+import torch.distributed as dist
 from datasets import Dataset, Sequence
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler, BatchSampler, SequentialSampler
 from transformers import DefaultDataCollator, DataCollator
 
 from src.utils import dynamic_import, get_label_converter
@@ -94,3 +98,80 @@ def setup_dataloaders(
     )
 
     return train_dataloader, eval_dataloader
+
+
+def batched_dataloader(dataset: Dataset, batch_size: int, **kwargs) -> DataLoader:
+    """ Sets up a dataloader which fetches whole batches with a single indexing call
+    (dataset[indices]), instead of fetching examples one by one and stacking them in
+    a collator. Only applicable to datasets in which all sequences have the same length,
+    e.g. when tokenizing with padding="max_length".
+
+    :param dataset: HF dataset, formatted as torch.
+    :param batch_size: batch size.
+    :param kwargs: any additional DataLoader arguments (e.g. num_workers).
+    :return: sequential dataloader.
+    """
+    return DataLoader(
+        dataset,
+        sampler=BatchSampler(SequentialSampler(dataset), batch_size=batch_size, drop_last=False),
+        batch_size=None,  # the sampler already yields batches, so automatic batching is disabled
+        **kwargs
+    )
+
+
+class BucketBatchSampler(Sampler[list[int]]):
+    """ Batch sampler which groups examples of similar length into the same batch,
+    so that dynamically padded batches contain as little padding as possible.
+
+    Indices are shuffled and split into buckets of batch_size * bucket_size_multiplier
+    examples. Each bucket is sorted by length and split into batches, and the order
+    of all batches is shuffled again. Under DDP, batches are sharded across processes.
+    """
+
+    def __init__(
+            self,
+            lengths: torch.Tensor,
+            batch_size: int,
+            bucket_size_multiplier: int = 50,
+            shuffle: bool = True,
+            seed: int = 0
+    ):
+        super().__init__(None)
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.rank, self.world_size = (dist.get_rank(), dist.get_world_size()) \
+            if dist.is_initialized() \
+            else (0, 1)
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[list[int]]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)  # identical on every DDP process
+
+        n = len(self.lengths)
+        indices = torch.randperm(n, generator=generator) if self.shuffle else torch.arange(n)
+
+        batches = []
+        for bucket in indices.split(self.bucket_size):
+            bucket = bucket[torch.argsort(self.lengths[bucket])]
+            batches.extend(bucket.split(self.batch_size))
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator)]
+
+        # repeat the batches cyclically so that every process gets the same number of batches,
+        # even if there are fewer batches than processes
+        total = len(self) * self.world_size
+        batches = (batches * ceil(total / len(batches)))[:total]
+
+        for batch in batches[self.rank::self.world_size]:
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        return ceil(ceil(len(self.lengths) / self.batch_size) / self.world_size)
@@ -1,28 +1,148 @@
 import logging
 import os
+from contextlib import contextmanager
+from math import ceil
+from typing import Optional
 
 import torch
+import torch.distributed as dist
 from omegaconf import DictConfig, OmegaConf
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel
 from transformers import AdapterConfig
 
 
 logger = logging.getLogger(__name__)
 
 
+def get_encoder(model) -> Optional[nn.Module]:
+    """ Returns the encoder of the model (e.g. model.roberta.encoder),
+    or None if the model does not have the usual BERT-like structure.
+    """
+    return getattr(model.base_model, "encoder", None)
+
+
+def expected_compiled_graphs(args, max_length: int) -> int:
+    """ Upper bound on the number of graphs compiled when compiling with dynamic=False.
+    Every distinct input shape is compiled separately, i.e. one graph per padded sequence
+    length (a multiple of 8, up to max_length) for every batch shape the dataloaders produce.
+    """
+    if hasattr(args, "training"):
+        # full and last training batch, full and last eval batch, and the last batch
+        # of the training set evaluation. training and evaluation are compiled separately,
+        # so the batch sizes are counted separately even if they are equal
+        batch_shapes = 2 + 2 + int(args.training.get("evaluate_on_train", False))
+    else:
+        # evaluation only (run_evaluation.py): full batch and the last batch of each dataset
+        batch_shapes = 3
+    return ceil(max_length / 8) * batch_shapes
+
+
 def maybe_compile(model, args):
+    """ Compiles the model using regional compilation, i.e. the encoder is compiled
+    as a single region, while the embeddings and the heads (the usual source of graph breaks)
+    are left in eager mode. If the encoder cannot be found, the whole model is compiled instead.
+    """
     if args.use_torch_compile:
-        logger.warning(f"Compiling the model")
-        model = torch.compile(model)
+        encoder = get_encoder(model)
+
+        # with dynamic=False, every (batch size, padded length, grad mode) combination is compiled separately.
+        # padding to a multiple of 8 bounds the number of lengths, but the total can still exceed
+        # dynamo's default cache size limit, past which it silently falls back to eager execution.
+        # without a tokenizer config (e.g. when evaluating), sequences are bounded by the model itself
+        max_length = args.tokenizer.max_length \
+            if hasattr(args, "tokenizer") \
+            else model.config.max_position_embeddings
+        torch._dynamo.config.cache_size_limit = max(  # noqa
+            torch._dynamo.config.cache_size_limit,  # noqa
+            expected_compiled_graphs(args, max_length)
+        )
+        logger.warning(f"Dynamo cache size limit set to {torch._dynamo.config.cache_size_limit}")  # noqa
+        if encoder is not None:
+            logger.warning(f"Compiling the encoder")
+            # compile the forward in place, so that parameter names (and checkpoints) stay the same
+            encoder.forward = torch.compile(encoder.forward, mode="reduce-overhead", fullgraph=True, dynamic=False)
+        else:
+            logger.warning(f"Encoder not found, compiling the whole model")
+            # graph breaks in the heads fall back to eager execution instead of failing
+            model = torch.compile(model, mode="reduce-overhead", fullgraph=False, dynamic=False)
         logger.warning(f"Model successfully compiled.")
     return model
 
 
 def set_device(model, args):
-    model = model.to(args.device)
+    device = torch.device("cuda", get_local_rank()) if dist.is_initialized() else args.device
+    model = model.to(device)
     logger.info(f"Model loaded successfully on device: {model.device}")
     return model
 
 
+def get_local_rank() -> int:
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+
+def is_main_process() -> bool:
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def maybe_init_distributed():
+    """ Initializes the NCCL process group if the script was launched
+    using torchrun (i.e. LOCAL_RANK is set in the environment).
+    Otherwise, training runs in a single process.
+    """
+    if "LOCAL_RANK" in os.environ:
+        dist.init_process_group(backend="nccl")
+        torch.cuda.set_device(get_local_rank())
+        logger.warning(f"Initialized distributed training: "
+                       f"rank {dist.get_rank()} of {dist.get_world_size()}, local rank {get_local_rank()}")
+
+
+def broadcast_from_main_process(value):
+    """ Returns the main process' value on every process (or the value itself if not distributed). """
+    if dist.is_initialized():
+        values = [value]
+        dist.broadcast_object_list(values, src=0)
+        value = values[0]
+    return value
+
+
+@contextmanager
+def main_process_first():
+    """ Runs the block on the main process before the other processes, which wait at a barrier.
+    Used for preprocessing, so that the main process populates the cache the other processes load from.
+    """
+    if dist.is_initialized() and not is_main_process():
+        dist.barrier()
+    yield
+    if dist.is_initialized() and is_main_process():
+        dist.barrier()
+
+
+def maybe_destroy_distributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def maybe_ddp(model):
+    if dist.is_initialized():
+        logger.warning(f"Wrapping the model in DistributedDataParallel")
+        model = DistributedDataParallel(
+            model,
+            device_ids=[get_local_rank()],
+            gradient_as_bucket_view=True,
+            static_graph=True
+        )
+    return model
+
+
+def unwrap_model(model):
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
 def setup_adapters(model, args: DictConfig, log_fn=logger.info):
     """ Sets up any adapters specified in the config
     Returns the fully set up model
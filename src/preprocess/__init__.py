@@ -1,6 +1,6 @@
 from typing import Callable
 
-from .steps import hf_map, logger, to_hf_dataset, convert_to_torch, sequence_columns
+from .steps import hf_map, default_num_proc, disk_cached, tokenizer_fingerprint, load_csv, drop_missing, logger, to_hf_dataset, convert_to_torch, sequence_columns
 from .steps import dummy, fine_tuning_dev, logger, to_hf_dataset, hf_map, convert_to_torch, sequence_columns
 from ..utils import dynamic_import, pipeline
 
@@ -1,10 +1,18 @@
+import hashlib
 import logging
+import os
+import shutil
 from typing import Callable, Optional
 
+import numpy as np
 import pandas as pd
+import pyarrow.compute as pc
+import torch
+from transformers import PreTrainedTokenizer, PreTrainedTokenizerFast
 import torch.utils.data
-from datasets import Dataset, Sequence
+from datasets import Dataset, Sequence, Value, load_dataset
 
+import src.utils
 from src.utils import pipeline
 
 logger = logging.getLogger(__name__)
@@ -22,11 +30,27 @@ def deduplication(subset: str | list[str]):
 def multihot_to_list(label_columns: list[str], result_column: str):
     def apply(df):
         logger.warning(f"Converting multihot columns to list: {label_columns}")
-        df[result_column] = df[label_columns].values.astype(float).tolist()
+        # one float32 array per row, which is converted to an arrow list without going through python floats
+        df[result_column] = list(df[label_columns].to_numpy(dtype=np.float32))
         return df
     return apply
 
 
+def hf_multihot_to_list(label_columns: list[str], result_column: str, num_proc: Optional[int] = None):
+    def multihot(batch):
+        return {
+            result_column: np.stack([batch[column] for column in label_columns], axis=1).astype(np.float32)
+        }
+
+    def apply(dataset: Dataset):
+        logger.warning(f"Converting multihot columns to list: {label_columns}")
+        # fixed-size list of float32, so that every example converts to a tensor of the same shape
+        features = dataset.features.copy()
+        features[result_column] = Sequence(Value("float32"), length=len(label_columns))
+        return dataset.map(multihot, batched=True, num_proc=num_proc, features=features)
+    return apply
+
+
 def drop(columns: list[str]):
     def apply(df):
         logger.warning(f"Dropping columns: {columns}")
@@ -42,18 +66,54 @@ def keep(columns: list[str]):
     return apply
 
 
+def load_csv(num_proc: Optional[int] = None) -> Callable[[str], Dataset]:
+    """ Loads a CSV file directly into an Arrow-backed HF dataset. The file is parsed
+    in chunks, so unlike pd.read_csv followed by to_hf_dataset, the whole
+    dataframe is never materialized in memory.
+    """
+    def apply(path: str) -> Dataset:
+        logger.warning(f"Loading CSV dataset from {path}")
+        return load_dataset("csv", data_files=path, split="train", num_proc=num_proc)
+    return apply
+
+
+def drop_missing(num_proc: Optional[int] = None) -> Callable[[Dataset], Dataset]:
+    """ HF dataset equivalent of DataFrame.dropna. """
+    def apply(dataset: Dataset) -> Dataset:
+        logger.warning(f"Dropping examples with missing values")
+        dataset = dataset.filter(
+            lambda batch: [all(value is not None for value in row) for row in zip(*batch.values())],
+            batched=True,
+            num_proc=num_proc
+        )
+        logger.warning(f"Remaining examples: {len(dataset)}")
+        return dataset
+    return apply
+
+
 def to_hf_dataset(df: pd.DataFrame) -> Dataset:
     logger.warning(f"Converting to HF dataset")
     return Dataset.from_pandas(df, preserve_index=False)
 
 
-def hf_map(mapping_fn: Callable, batched: bool = False):
+def hf_map(
+        mapping_fn: Callable,
+        batched: bool = False,
+        batch_size: int = 1000,
+        num_proc: Optional[int] = None
+):
     def apply(dataset: Dataset):
-        logger.warning(f"Mapping dataset using {mapping_fn.__name__}")
-        return dataset.map(mapping_fn, batched=batched)
+        logger.warning(f"Mapping dataset using {mapping_fn.__name__}"
+                       + (f" in {num_proc} processes" if num_proc else ""))
+        return dataset.map(mapping_fn, batched=batched, batch_size=batch_size, num_proc=num_proc)
     return apply
 
 
+def default_num_proc() -> int:
+    """ Number of processes used for dataset preprocessing (half of the available CPUs). """
+    return max((os.cpu_count() or 1) // 2, 1)
+
+
 def convert_to_torch(columns: list[str] | Callable[[Dataset], list[str]]) -> Callable[[Dataset], torch.utils.data.Dataset]:
     def apply(dataset: Dataset) -> torch.utils.data.Dataset:
         logger.warning(
@@ -67,6 +127,71 @@ def convert_to_torch(columns: list[str] | Callable[[Dataset], list[str]]) -> Cal
     return apply
 
 
+def tokenizer_fingerprint(tokenizer: PreTrainedTokenizer) -> str:
+    """ Hash which identifies the tokenizer by its contents rather than by its path,
+    i.e. it changes whenever the vocabulary, normalization (e.g. lowercasing) or
+    any of the tokenizer init kwargs change.
+    """
+    contents = tokenizer.backend_tokenizer.to_str() \
+        if isinstance(tokenizer, PreTrainedTokenizerFast) \
+        else repr(sorted(tokenizer.get_vocab().items()))
+    init_kwargs = repr(sorted(tokenizer.init_kwargs.items()))
+    return hashlib.sha256((contents + init_kwargs + str(len(tokenizer))).encode()).hexdigest()
+
+
+def preprocessing_code_fingerprint() -> str:
+    """ Hash of the modules which implement the preprocessing steps and tokenization,
+    so that changes to the preprocessing code invalidate cached datasets.
+    """
+    digest = hashlib.sha256()
+    for module_path in [__file__, src.utils.__file__]:
+        with open(module_path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def disk_cached(preprocess: Callable[[str], Dataset], cache_dir: str, *key_parts) -> Callable[[str], Dataset]:
+    """ Caches the output of a preprocessing pipeline on disk, in Arrow format.
+
+    The cache key is computed from the dataset path, its modification time,
+    the steps of the pipeline, the preprocessing code and the given key parts
+    (e.g. tokenizer fingerprint, max length, padding), so the cache is invalidated
+    whenever any of them change. Cached datasets are memory-mapped when loaded,
+    so they are not read into memory.
+
+    :param preprocess: preprocessing pipeline, mapping a dataset path to a dataset.
+    :param cache_dir: directory in which the preprocessed datasets are stored.
+    :param key_parts: anything else the output of the pipeline depends on.
+    :return: cached preprocessing pipeline.
+    """
+    def apply(path: str) -> Dataset:
+        path = os.path.abspath(path)
+        steps = [getattr(step, "__qualname__", repr(step)) for step in getattr(preprocess, "steps", [])]
+        cache_key = hashlib.sha256(repr((
+            path,
+            os.path.getmtime(path),
+            steps,
+            preprocessing_code_fingerprint(),
+            *key_parts
+        )).encode()).hexdigest()
+        cache_path = os.path.join(cache_dir, cache_key)
+
+        if not os.path.exists(cache_path):
+            dataset = preprocess(path)
+            # save to a temporary directory first, so that concurrent processes never see a partial cache
+            tmp_path = f"{cache_path}.tmp-{os.getpid()}"
+            dataset.save_to_disk(tmp_path)
+            try:
+                os.rename(tmp_path, cache_path)
+                logger.warning(f"Saved preprocessed dataset to cache: {cache_path}")
+            except OSError:  # another process has already populated the cache
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+        logger.warning(f"Loading preprocessed dataset from cache: {cache_path}")
+        return Dataset.load_from_disk(cache_path)
+    return apply
+
+
 def log_size(dataset: Dataset):
     logger.warning(f"Dataset size: {len(dataset)}")
     return dataset
@@ -80,6 +205,12 @@ def sequence_columns(dataset: Dataset) -> list[str]:
             dataset.features.items())))
 
 
+def sequence_lengths(dataset: Dataset, column: str = "input_ids") -> torch.Tensor:
+    """ Computes the length of every sequence in the given column, directly on the Arrow data. """
+    table = dataset.with_format("arrow", columns=[column])[:]
+    return torch.from_numpy(pc.list_value_length(table[column]).to_numpy())
+
+
 def maybe_sample(sample_size: int, random_state: int = 19041054) -> Callable[[pd.DataFrame], pd.DataFrame]:
     def apply(df: pd.DataFrame):
         if sample_size > (l := len(df)):
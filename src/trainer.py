@@ -1,5 +1,6 @@
 import gc
 import logging
+from contextlib import nullcontext
 from pprint import pformat
 from typing import Callable, Optional, Union, Tuple
 
@@ -8,9 +9,10 @@ import torch.optim
 from math import ceil
 from sklearn.metrics import precision_recall_fscore_support
 from torch import nn
+from torch.nn.parallel import DistributedDataParallel
 from torch.nn.utils import clip_grad_norm_
 from torch.optim.lr_scheduler import LRScheduler
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, DistributedSampler
 from tqdm import tqdm
 from transformers import PreTrainedTokenizer, BatchEncoding, DataCollator
 
@@ -18,6 +20,9 @@ from torch.nn.functional import binary_cross_entropy_with_logits, cross_entropy
 from transformers.modeling_outputs import SequenceClassifierOutput, MaskedLMOutput
 from transformers.utils import ModelOutput
 
+from src.data import BucketBatchSampler
+from src.model_utils import unwrap_model, is_main_process, broadcast_from_main_process
+from src.preprocess.steps import sequence_lengths
 from src.utils import save_checkpoint, is_improved, set_device, save_transformer_model, get_cls_token
 
 logger = logging.getLogger(__name__)
@@ -46,19 +51,50 @@ def fine_tuning_loss(
     return loss
 
 
-def pretraining_loss():
+def model_loss():
+    """ Uses the loss which the model computes in its forward pass.
+    HF models (and adapter heads) compute the loss whenever labels are
+    passed, so this avoids computing the same loss again outside of the model.
+    For multi-label classification models, this is the mean binary cross entropy.
+
+    :return:
+    """
+
     def loss(
             batch: BatchEncoding,
-            model_output: MaskedLMOutput
+            model_output: ModelOutput
     ):
         return model_output.loss
 
     return loss
 
 
+def pretraining_loss():
+    return model_loss()
+
+
 # TODO - there is code duplication of inner functions, think about how to refactor
 
 
+def warmup_compiled_model(
+        model: nn.Module,
+        batch: BatchEncoding,
+        get_loss: Callable[[BatchEncoding, ModelOutput], torch.Tensor],
+        amp_dtype: Optional[torch.dtype] = None,
+):
+    """ Runs a single forward and backward pass so that torch.compile
+    traces the model (and CUDA graphs are recorded) before the training loop.
+    Gradients computed during the warm-up are discarded.
+    """
+    logger.warning(f"Warming up the compiled model...")
+    with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=amp_dtype is not None):
+        output = model(**batch)
+        loss = get_loss(batch=batch, model_output=output)  # noqa
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+    logger.warning(f"Warm-up complete.")
+
+
 def train(
         args,
         model: nn.Module,
@@ -79,7 +115,14 @@ def train(
         use_ray_tune: bool = False,
         model_saving_callback: Callable = save_transformer_model,
         dataloader_num_workers: int = 8,
+        amp_dtype: Optional[torch.dtype] = None,
+        group_by_length: bool = False,
 ):
+    """ Trains the model.
+
+    If group_by_length is set, training batches are formed from examples of similar length,
+    which minimizes padding when batches are padded dynamically.
+    """
     global_step = 0
     early_stopping_step: Optional[int]
     best_metric_value: Optional[float]
@@ -99,6 +142,12 @@ def train(
     if gradient_accumulation_steps > 1:
         logger.warning(f"Gradient accumulation is enabled with {gradient_accumulation_steps} steps.")
 
+    if amp_dtype is not None:
+        logger.warning(f"Mixed precision training is enabled with {amp_dtype}.")
+
+    # loss scaling is only needed for fp16, bf16 has the same exponent range as fp32
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+
     if use_mlflow:
         import mlflow
         logger.warning(f"MLFlow is enabled. Logging to {mlflow.get_tracking_uri()}.")
@@ -106,13 +155,38 @@ def train(
     if use_ray_tune:
         from ray.air import session
 
+    if dataloader_num_workers == 0 and collate_fn is not None:
+        logger.warning(f"Data is collated in the main process, which blocks the training loop. "
+                       f"Consider setting dataloader_num_workers > 0.")
+
+    if group_by_length:
+        logger.warning(f"Grouping training examples of similar length into batches.")
+        train_sampler = BucketBatchSampler(
+            lengths=sequence_lengths(train_dataset),
+            batch_size=per_device_train_batch_size,
+            shuffle=True,
+            seed=args.random_seed  # the sampler has its own generator, so it is not seeded by set_seed
+        )
+        batching_kwargs = dict(batch_sampler=train_sampler)
+    else:
+        # when running under DDP, each process trains on its own shard of the dataset
+        train_sampler = DistributedSampler(train_dataset, shuffle=True, seed=args.random_seed) \
+            if torch.distributed.is_initialized() \
+            else None
+        batching_kwargs = dict(
+            batch_size=per_device_train_batch_size,
+            shuffle=train_sampler is None,
+            sampler=train_sampler
+        )
+
     # setup train dataloader
     train_dataloader = DataLoader(
         train_dataset,
-        batch_size=per_device_train_batch_size,
-        shuffle=True,
+        **batching_kwargs,
         pin_memory=True,
         num_workers=dataloader_num_workers,
+        persistent_workers=dataloader_num_workers > 0,
+        prefetch_factor=4 if dataloader_num_workers > 0 else None,
         collate_fn=collate_fn,
         # hardcoded for now
     )
@@ -124,6 +198,7 @@ def train(
             shuffle=False,
             pin_memory=True,
             num_workers=dataloader_num_workers,
+            persistent_workers=dataloader_num_workers > 0,  # workers are reused across evaluations
             collate_fn=collate_fn
         )
 
@@ -133,112 +208,157 @@ def train(
         shuffle=False,
         pin_memory=True,
         num_workers=dataloader_num_workers,
+        persistent_workers=dataloader_num_workers > 0,  # workers are reused across evaluations
         collate_fn=collate_fn
     )
 
-    epoch_steps = ceil(len(train_dataset) / per_device_train_batch_size)
+    epoch_steps = len(train_sampler) \
+        if group_by_length \
+        else ceil(len(train_dataloader.sampler) / per_device_train_batch_size)  # noqa
     if len(train_dataloader) != epoch_steps:
         logger.warning(f"Epoch steps is {epoch_steps}, but dataloader has {len(train_dataloader)} batches.")
         raise RuntimeError("ree")
 
+    # evaluation and checkpointing are done on the underlying (non-DDP) model
+    unwrapped_model = unwrap_model(model)
+
+    if getattr(args, "use_torch_compile", False):
+        warmup_compiled_model(
+            model=model,
+            batch=set_device(next(iter(train_dataloader)), unwrapped_model.device),
+            get_loss=get_loss,
+            amp_dtype=amp_dtype
+        )
+
+    # only trainable parameters have gradients (e.g. when training adapters)
+    trainable_parameters = [p for p in model.parameters() if p.requires_grad]
+
+    # a single progress bar for the whole run, workers persist across epochs. under DDP, only the main process shows it
+    pbar = tqdm(total=epochs * epoch_steps, smoothing=0.05, disable=not is_main_process())
+
     for epoch in range(1, epochs + 1):
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
 
         epoch_step = 0
-        for i, batch in (pbar := tqdm(
-                enumerate(train_dataloader),
-                total=len(train_dataloader),
-                desc=f"Epoch {epoch}")):
+        for batch in train_dataloader:
+            pbar.update(1)
             epoch_step += 1
             global_step += 1
 
-            set_device(batch, model.device)
+            set_device(batch, unwrapped_model.device)
+
+            is_update_step = (epoch_step % gradient_accumulation_steps == 0
+                              or epoch_step == epoch_steps)
+
+            # under DDP, skip the gradient all-reduce on accumulation steps
+            sync_context = model.no_sync() \
+                if not is_update_step and isinstance(model, DistributedDataParallel) \
+                else nullcontext()
+
+            with sync_context:
+                with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=amp_dtype is not None):
+                    output = model(**batch)
+                    loss = get_loss(batch=batch, model_output=output) / gradient_accumulation_steps  # noqa
 
-            output = model(**batch)
-            loss = get_loss(batch=batch, model_output=output)  # noqa
-            loss.backward()
+                scaler.scale(loss).backward()
 
-            if (epoch_step % gradient_accumulation_steps == 0
-                    or epoch_step == len(train_dataloader)
-            ):
+            if is_update_step:
                 # clip gradients if enabled
                 if max_grad_norm:
-                    clip_grad_norm_(model.parameters(), max_grad_norm)
+                    scaler.unscale_(optimizer)  # gradients have to be unscaled before clipping
+                    # foreach=None uses multi-tensor kernels on CUDA and falls back to a loop on CPU.
+                    # non-finite norms are not an error, since GradScaler skips such steps under fp16
+                    clip_grad_norm_(trainable_parameters, max_grad_norm, error_if_nonfinite=False, foreach=None)
 
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 scheduler.step()  # updates the learning rate
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)  # frees the gradients instead of zeroing them
                 pbar.set_description(
-                    f"Epoch = {epoch} (LR = {scheduler.get_last_lr()[-1]:.8f}; loss = {loss.item():.4f})"
+                    f"Epoch = {epoch} (LR = {scheduler.get_last_lr()[-1]:.8f}; "
+                    f"loss = {loss.item() * gradient_accumulation_steps:.4f})"
                 )
 
         # save checkpoint at the end of the epoch
-        logger.warning(f"Saving checkpoint at the end of epoch {epoch}...")
-        save_checkpoint(
-            model=model,  # noqa
-            checkpoint_name=f"{epoch}-ckpt",
-            use_mlflow=use_mlflow,
-            model_saving_callback=model_saving_callback
-        )
-
-        if evaluate_on_train:
-            logger.warning(f"Evaluating on training set after epoch {epoch}...")
-            metrics = do_evaluate(model, train_eval_dataloader, prefix="train")
-            # yea but we would want to do this with the full-blown batch size
-            logger.warning(f"[EPOCH = {epoch}; GLOBAL_STEP = {global_step}] {pformat(metrics)}")
-
-            if use_mlflow:
-                mlflow.log_metrics(
-                    metrics=metrics,
-                    step=epoch
-                )
-
-        if eval_dataloader:
-            logger.warning(F"Evaluating...")
-            metrics = do_evaluate(model, eval_dataloader, prefix="eval")
-            logger.warning(f"[EPOCH = {epoch}; GLOBAL_STEP = {global_step}] {pformat(metrics)}")
+        if is_main_process():
+            logger.warning(f"Saving checkpoint at the end of epoch {epoch}...")
+            save_checkpoint(
+                model=unwrapped_model,  # noqa
+                checkpoint_name=f"{epoch}-ckpt",
+                use_mlflow=use_mlflow,
+                model_saving_callback=model_saving_callback
+            )
+
+        # under DDP, evaluation (and the early stopping decision) is done only by the main process,
+        # all processes hold identical weights, so evaluating on every process would only duplicate the work
+        should_stop = False
+        if is_main_process():
+            if evaluate_on_train:
+                logger.warning(f"Evaluating on training set after epoch {epoch}...")
+                metrics = do_evaluate(unwrapped_model, train_eval_dataloader, prefix="train")
+                # yea but we would want to do this with the full-blown batch size
+                logger.warning(f"[EPOCH = {epoch}; GLOBAL_STEP = {global_step}] {pformat(metrics)}")
+
+                if use_mlflow:
+                    mlflow.log_metrics(
+                        metrics=metrics,
+                        step=epoch
+                    )
 
-            if use_mlflow:
-                mlflow.log_metrics(
-                    metrics=metrics,
-                    step=epoch
-                )
+            if eval_dataloader:
+                logger.warning(F"Evaluating...")
+                metrics = do_evaluate(unwrapped_model, eval_dataloader, prefix="eval")
+                logger.warning(f"[EPOCH = {epoch}; GLOBAL_STEP = {global_step}] {pformat(metrics)}")
 
-            if use_ray_tune:
-                session.report(
-                    {"epoch": epoch, **metrics}
-                )  # this KILLS the run if the metrics are bad
-
-            if use_early_stopping:
-                current_metric_value = metrics[args.early_stopping.metric_for_best_model]
-                #  and epoch >= args.early_stopping.start:
-                if is_improved(
-                        current_metric_value,
-                        best_metric_value,  # noqa
-                        args.early_stopping.greater_is_better
-                ):
-                    # save checkpoint due to the metric improvement
-                    save_checkpoint(
-                        model=model,  # noqa
-                        checkpoint_name="best_checkpoint",
-                        use_mlflow=use_mlflow,
-                        model_saving_callback=model_saving_callback,
+                if use_mlflow:
+                    mlflow.log_metrics(
+                        metrics=metrics,
+                        step=epoch
                     )
 
-                    if epoch >= args.early_stopping.start:  # early stopping is active
-                        logger.warning(
-                            f"""Resetting early stopping patience based on {args.early_stopping.metric_for_best_model}.
+                if use_ray_tune:
+                    session.report(
+                        {"epoch": epoch, **metrics}
+                    )  # this KILLS the run if the metrics are bad
+
+                if use_early_stopping:
+                    current_metric_value = metrics[args.early_stopping.metric_for_best_model]
+                    #  and epoch >= args.early_stopping.start:
+                    if is_improved(
+                            current_metric_value,
+                            best_metric_value,  # noqa
+                            args.early_stopping.greater_is_better
+                    ):
+                        # save checkpoint due to the metric improvement
+                        save_checkpoint(
+                            model=unwrapped_model,  # noqa
+                            checkpoint_name="best_checkpoint",
+                            use_mlflow=use_mlflow,
+                            model_saving_callback=model_saving_callback,
+                        )
+
+                        if epoch >= args.early_stopping.start:  # early stopping is active
+                            logger.warning(
+                                f"""Resetting early stopping patience based on {args.early_stopping.metric_for_best_model}.
                                        Current value: {current_metric_value}
                                        Best_value: {best_metric_value}""")
-                        early_stopping_step = 0
-                        best_metric_value = current_metric_value
+                            early_stopping_step = 0
+                            best_metric_value = current_metric_value
+
+                    elif epoch >= args.early_stopping.start:  # metric has not improved and early stopping is active
+                        early_stopping_step += 1  # noqa
+                        if early_stopping_step == args.early_stopping.patience:
+                            # early stopping
+                            logger.warning(f"Early stopping patience has reached the critical threshold of "
+                                           f"{args.early_stopping.patience}. Stopping the run.")
+                            should_stop = True
+
+        if broadcast_from_main_process(should_stop):  # all processes have to stop together
+            pbar.close()
+            return
 
-                elif epoch >= args.early_stopping.start:  # metric has not improved and early stopping is active
-                    early_stopping_step += 1  # noqa
-                    if early_stopping_step == args.early_stopping.patience:
-                        # early stopping
-                        logger.warning(f"Early stopping patience has reached the critical threshold of "
-                                       f"{args.early_stopping.patience}. Stopping the run.")
-                        return
+    pbar.close()
 
 
 def eval_loss_only(
@@ -255,13 +375,14 @@ def eval_loss_only(
         logits_all = torch.empty(eval_size, 33, device="cpu", dtype=torch.float32)
         references_all = torch.empty(eval_size, 33, device="cpu", dtype=torch.float32)
 
-        with torch.no_grad():
+        offset = 0  # batches are not necessarily of eval_dataloader.batch_size (e.g. with a batch sampler)
+        with torch.inference_mode():
             for i, batch in tqdm(enumerate(eval_dataloader), total=len(eval_dataloader), desc="Validation"):
                 set_device(batch, model.device)
                 output = model(**batch)
                 references = batch["labels"]
 
-                batch_slice = slice(i * eval_dataloader.batch_size, (i + 1) * eval_dataloader.batch_size)
+                batch_slice = slice(offset, offset := offset + len(references))
                 logits_all[batch_slice] = output["logits"].detach().cpu()
                 references_all[batch_slice] = references.detach().cpu()
 
@@ -278,12 +399,13 @@ def eval_loss_only(
     return evaluate
 
 
-@torch.no_grad()
+@torch.inference_mode()
 def do_predict(
         model: nn.Module,
         dataloader: DataLoader,
         num_labels: int = 19,
-        output_hidden_states: bool = False
+        output_hidden_states: bool = False,
+        amp_dtype: Optional[torch.dtype] = None,
 ) -> Union[Tuple[torch.Tensor, torch.Tensor], Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
     """ Runs inference using the given dataloader.
     Model outputs are transformed to probabilities using sigmoid function.
@@ -301,16 +423,18 @@ def do_predict(
     if output_hidden_states:
         hidden_states = np.empty(shape=(data_len, model.config.hidden_size), dtype=float)
 
+    offset = 0  # batches are not necessarily of dataloader.batch_size (e.g. with a batch sampler)
     model.eval()
     for i, batch in tqdm(enumerate(dataloader), total=len(dataloader), desc="Prediction loop"):
         set_device(batch, model.device)
-        output = model(**batch, output_hidden_states=output_hidden_states)
-        batch_slice = slice(i * dataloader.batch_size, (i + 1) * dataloader.batch_size)
+        with torch.autocast(device_type="cuda", dtype=amp_dtype, enabled=amp_dtype is not None):
+            output = model(**batch, output_hidden_states=output_hidden_states)
+        batch_slice = slice(offset, offset := offset + len(batch["labels"]))
 
         if output_hidden_states:
-            hidden_states[batch_slice, :] = get_cls_token(output.hidden_states[-1]).detach().cpu().numpy()
+            hidden_states[batch_slice, :] = get_cls_token(output.hidden_states[-1]).detach().float().cpu().numpy()
 
-        predictions[batch_slice] = output["logits"].detach().cpu()
+        predictions[batch_slice] = output["logits"].detach().float().cpu()
         references[batch_slice] = batch["labels"].detach().cpu()
 
     model.train()
@@ -357,6 +481,7 @@ def compute_metrics(
 def evaluate_finetuning(
         evaluation_threshold: float = 0.75,
         loss_fn=binary_cross_entropy_with_logits,
+        amp_dtype: Optional[torch.dtype] = None,
 ) -> Callable[[nn.Module, DataLoader, str], dict[str, float]]:
     def evaluate(
             model: nn.Module,
@@ -364,7 +489,7 @@ def evaluate_finetuning(
             prefix: str = "eval"
     ) -> dict[str, float]:
         model.eval()
-        predictions, references = do_predict(model, eval_dataloader)
+        predictions, references = do_predict(model, eval_dataloader, amp_dtype=amp_dtype)
         model.train()
 
         return compute_metrics(predictions, references, prefix, loss_fn, evaluation_threshold)
@@ -385,7 +510,7 @@ def evaluate_pretraining():
 
         total_loss = 0
 
-        with torch.no_grad():
+        with torch.inference_mode():
             for i, batch in tqdm(enumerate(eval_dataloader), total=len(eval_dataloader), desc="Validation"):
                 set_device(batch, model.device)
                 output: MaskedLMOutput = model(**batch)
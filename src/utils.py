@@ -2,7 +2,7 @@ import json
 import operator
 from functools import partial
 from pprint import pformat
-from typing import Callable
+from typing import Callable, Optional
 import logging
 import os
 
@@ -45,6 +45,7 @@ def pipeline(*fs) -> Callable:
             output = f(output)
         return output
 
+    pipe.steps = fs  # exposed so that the pipeline can be identified (e.g. for caching)
     return pipe
 
 
@@ -131,7 +132,7 @@ def get_tokenization_fn(
             padding=padding,
             truncation=truncation,
             max_length=max_length,
-            return_tensors="pt",
+            return_tensors=None,  # datasets stores the outputs as arrow lists anyway
             return_special_tokens_mask=return_special_tokens_mask
         )
 
@@ -206,13 +207,19 @@ def setup_optimizers(
         epoch_steps: int,
         scheduler_type: str
 ) -> (Optimizer, LRScheduler):
+    # fused kernels are only available for CUDA tensors, otherwise fall back to the multi-tensor implementation
+    on_cuda = all(p.is_cuda for p in model.parameters())
+    if not on_cuda:
+        logger.warning("Model is not on a CUDA device, using foreach AdamW instead of fused AdamW.")
+
     optimizer = AdamW(
         model.parameters(),
         lr=lr,
         weight_decay=weight_decay,
         eps=adam_epsilon,
-        capturable=True,  # make optimizer capturable in a CUDA graph
-        fused=True  # fuse operations into a single CUDA kernel (TODO - might break on TF32)
+        capturable=on_cuda,  # make optimizer capturable in a CUDA graph
+        fused=on_cuda,  # fuse operations into a single CUDA kernel (TODO - might break on TF32)
+        foreach=None if on_cuda else True
     )
 
     # calculate the warmup steps
@@ -239,12 +246,29 @@ def maybe_tf32(args):
         logger.warning("TF32 enabled.")
 
 
+def get_amp_dtype(args) -> Optional[torch.dtype]:
+    """ Selects the autocast dtype for mixed precision training.
+    bf16 is used on GPUs which support it (Ampere and newer), fp16 otherwise.
+    Mixed precision is only used when training on a GPU.
+
+    :param args: config. Mixed precision is enabled by setting use_amp.
+    :return: autocast dtype, or None if mixed precision is disabled.
+    """
+    if not getattr(args, "use_amp", False):
+        return None
+    if not str(args.device).startswith("cuda") or not torch.cuda.is_available():
+        logger.warning(f"Mixed precision is only supported on CUDA devices, training in full precision.")
+        return None
+    return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
+
 def get_tokenizer(args) -> PreTrainedTokenizer:
     return AutoTokenizer.from_pretrained(
         args.tokenizer.pretrained_model_name_or_path,
         model_max_length=args.tokenizer.max_length,
         do_lower_case=args.tokenizer.do_lower_case,
         cache_dir=args.tokenizer.cache_dir,
+        use_fast=True,
     )
 
 # here we need to decouple model and tokenizer, becasue we didnt save tokenizer
@@ -252,11 +276,13 @@ def get_tokenizer(args) -> PreTrainedTokenizer:
 
 def set_device(
         batch: BatchEncoding,
-        device: torch.device
+        device: torch.device,
+        non_blocking: bool = True
 ) -> BatchEncoding:
+    # copies from pinned memory are asynchronous w.r.t. the host when non_blocking is set
     for key, value in batch.items():
         if isinstance(value, torch.Tensor):
-            batch[key] = value.to(device)
+            batch[key] = value.to(device, non_blocking=non_blocking)
     return batch
 
 
@@ -272,12 +298,13 @@ def get_representations(
         semantic_composition: Callable[[torch.Tensor], torch.Tensor] = get_cls_token
 ):
     representations = np.empty((n_examples, model.config.hidden_size))
-    with torch.no_grad():
+    offset = 0  # batches are not necessarily of dataloader.batch_size (e.g. with a batch sampler)
+    with torch.inference_mode():
         for i, batch in tqdm(enumerate(dataloader), total=len(dataloader), desc="Inference"):
             set_device(batch, model.device)
             hidden_states = model(**batch).last_hidden_state
 
-            slice_index = slice(i * dataloader.batch_size, (i+1) * dataloader.batch_size)
+            slice_index = slice(offset, offset := offset + hidden_states.shape[0])
             representations[slice_index, :] = semantic_composition(hidden_states).detach().cpu().numpy()
 
         # TODO - make this layer by layer
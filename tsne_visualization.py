@@ -10,10 +10,10 @@ import pandas as pd
 import torch
 from matplotlib import pyplot as plt
 from sklearn.manifold import TSNE
-from torch.utils.data import DataLoader
-from transformers import PreTrainedModel, AutoModel, PreTrainedTokenizer, AutoTokenizer, DefaultDataCollator
+from transformers import PreTrainedModel, AutoModel, PreTrainedTokenizer, AutoTokenizer
 from transformers.utils import PaddingStrategy
 
+from src.data import batched_dataloader
 from src.preprocess import to_hf_dataset, hf_map, convert_to_torch, sequence_columns
 from src.preprocess.steps import keep, maybe_sample, log_size, deduplication
 from src.utils import setup_logging, get_tokenization_fn, pipeline, get_representations, get_cls_token
@@ -156,10 +156,10 @@ def main():
 
         logger.warning(f"{dataset_name} finished processing.")
 
-        dataloader = DataLoader(
+        # examples are padded to max_length, so whole batches can be fetched at once
+        dataloader = batched_dataloader(
             dataset,
             batch_size=args.batch_size,
-            collate_fn=DefaultDataCollator(return_tensors="pt")
         )
 
         all_embeddings.append(get_representations(